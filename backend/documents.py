@@ -0,0 +1,48 @@
+"""
+Document loading and chunking. Kept separate from main.py so process pool workers
+can import it without pulling in the embedding model or the web app.
+"""
+import os
+from langchain_community.document_loaders import PyPDFium2Loader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# Less common formats import their loaders on first use to keep startup light
+def text_loader(file_path: str):
+    from langchain_community.document_loaders import TextLoader
+    return TextLoader(file_path)
+
+def docx_loader(file_path: str):
+    from langchain_community.document_loaders import Docx2txtLoader
+    return Docx2txtLoader(file_path)
+
+# Document loader for each supported file extension
+LOADERS = {
+    ".txt": text_loader,
+    # PDFium extracts text several times faster than the pure-Python pypdf behind PyPDFLoader
+    ".pdf": PyPDFium2Loader,
+    ".doc": docx_loader,
+    ".docx": docx_loader,
+}
+
+# Shared splitter; it holds no per-document state, so it is built once at import
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=1000,
+    chunk_overlap=200,
+    length_function=len,
+    separators=["\n\n", "\n", " ", ""]
+)
+
+def process_document(file_path: str):
+    ext = os.path.splitext(file_path)[1].lower()
+    loader = LOADERS.get(ext)
+    if loader is None:
+        raise ValueError(f"Unsupported file type: {ext}")
+
+    documents = loader(file_path).load()
+
+    # PDFium (and Windows-authored text files) end lines with \r\n, which would keep the
+    # splitter's "\n\n" paragraph separator from matching and leave stray \r in chunks
+    for document in documents:
+        document.page_content = document.page_content.replace("\r\n", "\n").replace("\r", "\n")
+
+    return TEXT_SPLITTER.split_documents(documents)
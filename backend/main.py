@@ -1,28 +1,398 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from typing import List, Dict, Optional
 import os
 import aiohttp
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_huggingface import HuggingFaceEmbeddings
+import aiofiles
 from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.embeddings import Embeddings
 import shutil
 import asyncio
-import json
+import orjson
+import faiss
+import numpy as np
+import sqlite3
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from documents import process_document
 
 # Configure paths
 BASE_DIR = "data"
 CHAT_HISTORY_DIR = os.path.join(BASE_DIR, "chat_history")
+EMBEDDING_CACHE_DIR = os.path.join(BASE_DIR, "_embcache")
+ONNX_MODEL_DIR = os.path.join(BASE_DIR, "_onnx")
 os.makedirs(BASE_DIR, exist_ok=True)
 os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
+os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+
+# Size of each read when streaming an upload to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Number of chunks sent through the embedding model per forward pass
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "128"))
+
+# Worker processes used to parse documents in parallel. Kept modest by default
+# since loaders contend on disk once the CPU is no longer the bottleneck
+LOAD_DOCUMENTS_NUMBER_OF_THREADS = int(os.environ.get(
+    "LOAD_DOCUMENTS_NUMBER_OF_THREADS",
+    str(min(4, max(1, (os.cpu_count() or 1) - 1)))
+))
+
+# Folders switch from an exact flat index to an HNSW graph once they hold this many
+# chunks. With M=32 each vector carries ~256 bytes of graph links on top of its
+# 1.5 KB of floats and builds are slower, in exchange for O(log n) search at ~99%
+# recall (efSearch=64) instead of scanning every vector per query
+EMBEDDING_DIM = 384
+HNSW_MIN_VECTORS = int(os.environ.get("HNSW_MIN_VECTORS", "5000"))
+# An HNSW folder only drops back to a flat index below this size, so a folder sitting
+# around HNSW_MIN_VECTORS doesn't switch index type on every upload and delete
+HNSW_DOWNGRADE_VECTORS = int(HNSW_MIN_VECTORS * 0.8)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# "onnx" runs an int8-quantized export through ONNX Runtime, which is several times
+# faster than PyTorch eager mode on CPU; "torch" uses sentence-transformers directly.
+# torch is only imported when it may be needed: for the torch backend, or to pick a
+# backend when none is set (onnx on CPU-only machines, torch when a GPU is present)
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND")
+EMBEDDING_DEVICE = "cpu"
+if EMBEDDING_BACKEND != "onnx":
+    import torch
+
+    # Run the embedding model in half precision on accelerators; CPU stays in FP32
+    # since FP16/BF16 matmuls are emulated (and slower) on most CPUs
+    if torch.cuda.is_available():
+        EMBEDDING_DEVICE = "cuda"
+    elif torch.backends.mps.is_available():
+        EMBEDDING_DEVICE = "mps"
+    EMBEDDING_DTYPE = torch.float32 if EMBEDDING_DEVICE == "cpu" else torch.float16
+
+    if EMBEDDING_BACKEND is None:
+        EMBEDDING_BACKEND = "onnx" if EMBEDDING_DEVICE == "cpu" else "torch"
+
+class EmbeddingCache(Embeddings):
+    """
+    Wraps an embedding model with an on-disk cache keyed by the sha256 of each text,
+    so chunks that were embedded before (e.g. when rebuilding after a delete) are
+    looked up instead of recomputed. Query embeddings are memoized in memory.
+    """
+
+    def __init__(self, model: Embeddings, namespace: str, query_cache_size: int = 4096):
+        self.model = model
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(EMBEDDING_CACHE_DIR, f"{namespace}.sqlite"),
+            check_same_thread=False
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._db.commit()
+        # LRU of query text -> vector for repeated chat messages ("summarize", "continue", ...)
+        self._query_cache: OrderedDict = OrderedDict()
+        self._query_cache_size = query_cache_size
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _find_cached(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+        return found
+
+    def _store(self, entries: Dict[str, List[float]]):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in entries.items()]
+            )
+            self._db.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self._find_cached(list(set(keys)))
+
+        # Embed all misses in a single batch
+        uncached = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                uncached[key] = text
+        if uncached:
+            vectors = self.model.embed_documents(list(uncached.values()))
+            new_entries = dict(zip(uncached.keys(), vectors))
+            self._store(new_entries)
+            cached.update(new_entries)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed several chat queries, reusing in-memory vectors for repeated messages.
+        Misses share one forward pass and are not persisted to disk.
+        """
+        found = {}
+        with self._lock:
+            for text in texts:
+                if text in self._query_cache:
+                    self._query_cache.move_to_end(text)
+                    found[text] = self._query_cache[text]
+
+        misses = list(dict.fromkeys(text for text in texts if text not in found))
+        if misses:
+            vectors = self.model.embed_documents(misses)
+            with self._lock:
+                for text, vector in zip(misses, vectors):
+                    found[text] = self._query_cache[text] = tuple(vector)
+                while len(self._query_cache) > self._query_cache_size:
+                    self._query_cache.popitem(last=False)
+
+        return [list(found[text]) for text in texts]
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence-transformers model exported to ONNX with dynamic int8 quantization and run
+    through ONNX Runtime, using the same mean pooling and normalization as the PyTorch
+    model. The quantized model is built on first use and kept under ONNX_MODEL_DIR.
+    Only that one-time export goes through optimum (which imports torch); inference
+    uses a plain onnxruntime session.
+    """
+
+    def __init__(self, model_id: str, batch_size: int, max_length: int = 256):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        save_dir = os.path.join(ONNX_MODEL_DIR, f"{model_id.split('/')[-1]}-int8")
+        model_path = os.path.join(save_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+            print(f"Exporting {model_id} to quantized ONNX in {save_dir}")
+            model = ORTModelForFeatureExtraction.from_pretrained(
+                model_id, export=True, provider="CPUExecutionProvider"
+            )
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(
+                save_dir=save_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            )
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(save_dir)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            model_path,
+            sess_options=session_options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(save_dir)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            feed = {name: value.astype(np.int64) for name, value in inputs.items() if name in self.input_names}
+            token_embeddings = self.session.run(None, feed)[0]
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
 
 # Initialize embeddings
-embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+if EMBEDDING_BACKEND == "onnx":
+    embeddings = EmbeddingCache(
+        OnnxEmbeddings("sentence-transformers/all-MiniLM-L6-v2", batch_size=EMBEDDING_BATCH_SIZE),
+        namespace="all-MiniLM-L6-v2-normalized-onnx-int8"
+    )
+else:
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    embeddings = EmbeddingCache(
+        HuggingFaceEmbeddings(
+            model_name="all-MiniLM-L6-v2",
+            model_kwargs={"device": EMBEDDING_DEVICE, "model_kwargs": {"torch_dtype": EMBEDDING_DTYPE}},
+            encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE, "normalize_embeddings": True}
+        ),
+        namespace="all-MiniLM-L6-v2-normalized"
+    )
 
 # Dictionary to store vector stores for each folder
-vector_stores: Dict[str, FAISS] = {}
+vector_stores: Dict[str, "FolderVectorStore"] = {}
+
+# Worker processes for CPU-bound document parsing, created in lifespan
+process_pool: Optional[ProcessPoolExecutor] = None
+
+def new_process_pool() -> ProcessPoolExecutor:
+    # Spawned workers only import the documents module, not this one, so they don't
+    # load the embedding model or inherit its threads and the cache's SQLite handle
+    return ProcessPoolExecutor(
+        max_workers=LOAD_DOCUMENTS_NUMBER_OF_THREADS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+# Folders whose in-memory vector store has changes not yet written to disk. A
+# background task saves them every VECTOR_STORE_SAVE_INTERVAL seconds; the lock
+# keeps stores from being modified while they are being serialized
+VECTOR_STORE_SAVE_INTERVAL = 5
+dirty_vector_stores: set = set()
+vector_store_lock = asyncio.Lock()
+
+async def save_dirty_vector_stores():
+    async with vector_store_lock:
+        failed = set()
+        while dirty_vector_stores:
+            folder_id = dirty_vector_stores.pop()
+            store = vector_stores.get(folder_id)
+            if store is None:
+                continue
+            vectorstore_path = os.path.join(BASE_DIR, folder_id, "vectorstore")
+            try:
+                await asyncio.to_thread(store.save_local, vectorstore_path)
+            except Exception as e:
+                print(f"Error saving vector store for folder {folder_id}: {e}")
+                failed.add(folder_id)
+        dirty_vector_stores.update(failed)
+
+async def save_vector_stores_periodically():
+    while True:
+        await asyncio.sleep(VECTOR_STORE_SAVE_INTERVAL)
+        await save_dirty_vector_stores()
+
+# Chat queries arriving within QUERY_BATCH_WINDOW seconds of each other (up to
+# QUERY_BATCH_SIZE) are embedded in one forward pass and searched with one FAISS call per folder
+QUERY_BATCH_WINDOW = 0.005
+QUERY_BATCH_SIZE = 32
+
+class QueryBatcher:
+    """Coalesces concurrent similarity searches into batched embedding and index searches"""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+
+    async def search(self, store: "FolderVectorStore", query: str, k: int):
+        if self.closed:
+            raise RuntimeError("Server is shutting down")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((store, query, k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                deadline = loop.time() + QUERY_BATCH_WINDOW
+                while len(batch) < QUERY_BATCH_SIZE:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                try:
+                    results = await asyncio.to_thread(self._search_batch, batch)
+                except Exception as e:
+                    # Embedding the batch failed, which affects every query in it
+                    results = [e] * len(batch)
+            except asyncio.CancelledError:
+                self._fail(batch)
+                raise
+
+            for (*_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def close(self):
+        """Stop accepting searches and fail any still waiting in the queue"""
+        self.closed = True
+        pending = []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        self._fail(pending)
+
+    @staticmethod
+    def _fail(batch):
+        for *_, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("Server is shutting down"))
+
+    @staticmethod
+    def _search_batch(batch):
+        """Returns, per query, its documents or the exception raised by its folder's search"""
+        vectors = np.asarray(embeddings.embed_queries([query for _, query, _, _ in batch]), dtype=np.float32)
+
+        # One index search per folder, covering every query for that folder
+        groups: Dict[int, List[int]] = {}
+        for position, (store, _, _, _) in enumerate(batch):
+            groups.setdefault(id(store), []).append(position)
+
+        results = [None] * len(batch)
+        for positions in groups.values():
+            store = batch[positions[0]][0]
+            k = max(batch[position][2] for position in positions)
+            try:
+                # Search and map rows to documents under one lock, so the index and id map
+                # can't be swapped by a write in between
+                with store.lock:
+                    _, indices = store.index.search(vectors[positions], k)
+                    for position, row in zip(positions, indices):
+                        results[position] = [
+                            store.docstore.search(store.index_to_docstore_id[i])
+                            for i in row[:batch[position][2]] if i != -1
+                        ]
+            except Exception as e:
+                # A broken folder index only fails the chats for that folder
+                print(f"Error searching vector store: {e}")
+                for position in positions:
+                    results[position] = e
+        return results
+
+query_batcher = QueryBatcher()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -30,23 +400,48 @@ async def lifespan(app: FastAPI):
     Lifespan context manager for FastAPI application.
     Handles startup and shutdown events.
     """
+    global process_pool
+    process_pool = new_process_pool()
+
     # Startup: Load vector stores
     print("Starting up: Loading vector stores...")
+    candidates = []
     for folder in os.listdir(BASE_DIR):
-        folder_path = os.path.join(BASE_DIR, folder)
-        vectorstore_path = os.path.join(folder_path, "vectorstore")
+        vectorstore_path = os.path.join(BASE_DIR, folder, "vectorstore")
         if os.path.exists(vectorstore_path):
-            try:
-                vector_stores[folder] = FAISS.load_local(vectorstore_path, embeddings)
-                print(f"Successfully loaded vector store for folder {folder}")
-            except Exception as e:
-                print(f"Error loading vector store for folder {folder}: {e}")
+            candidates.append((folder, vectorstore_path))
+
+    # Loading is mostly file I/O, so read all folders concurrently
+    results = await asyncio.gather(
+        *[asyncio.to_thread(load_vector_store, vectorstore_path) for _, vectorstore_path in candidates],
+        return_exceptions=True
+    )
+    for (folder, _), result in zip(candidates, results):
+        if isinstance(result, Exception):
+            print(f"Error loading vector store for folder {folder}: {result}")
+        else:
+            vector_stores[folder] = result
+            print(f"Successfully loaded vector store for folder {folder}")
+
+    save_task = asyncio.create_task(save_vector_stores_periodically())
+    query_batch_task = asyncio.create_task(query_batcher.run())
+
+    # Shared HTTP session so requests to LM Studio reuse pooled keep-alive connections
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+    )
     
     yield  # Server is running
     
-    # Shutdown: Clean up resources
+    # Shutdown: Flush pending vector store changes, then clean up resources
     print("Shutting down: Cleaning up resources...")
+    save_task.cancel()
+    query_batch_task.cancel()
+    query_batcher.close()
+    await save_dirty_vector_stores()
     vector_stores.clear()
+    process_pool.shutdown()
+    await app.state.http.close()
 
 # Create FastAPI app with lifespan
 app = FastAPI(lifespan=lifespan)
@@ -65,70 +460,219 @@ def get_folder_path(folder_id: str) -> str:
     os.makedirs(folder_path, exist_ok=True)
     return folder_path
 
-def save_chat_history(chat_id: str, history: list):
+async def save_chat_history(chat_id: str, history: list):
     """Save chat history to disk"""
     history_path = os.path.join(CHAT_HISTORY_DIR, f"{chat_id}.json")
-    with open(history_path, 'w') as f:
-        json.dump(history, f)
+    async with aiofiles.open(history_path, 'wb') as f:
+        await f.write(orjson.dumps(history))
 
-def load_chat_history(chat_id: str) -> list:
+async def load_chat_history(chat_id: str) -> list:
     """Load chat history from disk"""
     history_path = os.path.join(CHAT_HISTORY_DIR, f"{chat_id}.json")
     if os.path.exists(history_path):
-        with open(history_path, 'r') as f:
-            return json.load(f)
+        async with aiofiles.open(history_path, 'rb') as f:
+            return orjson.loads(await f.read())
     return []
 
-def process_document(file_path: str):
-    print(f"Starting to process document: {file_path}")  # Debug log
-    
-    try:
-        ext = os.path.splitext(file_path)[1].lower()
-        print(f"File extension: {ext}")  # Debug log
-        
-        if ext == '.txt':
-            loader = TextLoader(file_path)
-        elif ext == '.pdf':
-            try:
-                loader = PyPDFLoader(file_path)
-                print("Successfully created PDF loader")  # Debug log
-            except Exception as e:
-                print(f"Error creating PDF loader: {str(e)}")  # Debug log
-                raise ValueError(f"Error loading PDF: {str(e)}")
-        elif ext in ['.doc', '.docx']:
-            loader = Docx2txtLoader(file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {ext}")
+def chunk_ids(filename: str, chunks) -> List[str]:
+    """Vector store ids for a file's chunks, so they can later be removed by filename"""
+    return [f"{filename}:{i}" for i in range(len(chunks))]
 
-        try:
-            print("Loading document content")  # Debug log
-            documents = loader.load()
-            print(f"Successfully loaded document with {len(documents)} pages/sections")  # Debug log
-        except Exception as e:
-            print(f"Error loading document content: {str(e)}")  # Debug log
-            raise ValueError(f"Error loading document content: {str(e)}")
-
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-            separators=["\n\n", "\n", " ", ""]
-        )
-        
-        try:
-            print("Splitting document into chunks")  # Debug log
-            chunks = text_splitter.split_documents(documents)
-            print(f"Successfully split into {len(chunks)} chunks")  # Debug log
-            return chunks
-        except Exception as e:
-            print(f"Error splitting document: {str(e)}")  # Debug log
-            raise ValueError(f"Error splitting document: {str(e)}")
+def file_chunk_ids(store, filename: str) -> List[str]:
+    """Ids of a file's chunks in the store"""
+    # Compare the whole filename part, so "notes" doesn't match "notes:v2.txt"
+    return [doc_id for doc_id in store.index_to_docstore_id.values() if doc_id.rsplit(":", 1)[0] == filename]
 
-    except Exception as e:
-        print(f"Error in process_document: {str(e)}")  # Debug log
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")  # Debug log
-        raise
+def embed_chunks(chunks):
+    """
+    Embed all chunks in one batched call, returning (text, vector) pairs and metadatas.
+    Repeated chunks (page headers, footers, boilerplate) are embedded once and share the vector.
+    """
+    texts = [chunk.page_content for chunk in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+
+    unique_positions: Dict[str, int] = {}
+    back = [unique_positions.setdefault(text, len(unique_positions)) for text in texts]
+    unique_vectors = embeddings.embed_documents(list(unique_positions))
+    vectors = [unique_vectors[position] for position in back]
+    return list(zip(texts, vectors)), metadatas
+
+def use_hnsw(num_vectors: int, currently_hnsw: bool) -> bool:
+    """Whether a folder of this size should use HNSW, given the index type it has now"""
+    if currently_hnsw:
+        return num_vectors >= HNSW_DOWNGRADE_VECTORS
+    return num_vectors >= HNSW_MIN_VECTORS
+
+def new_faiss_index(hnsw: bool):
+    """
+    Flat index for small folders, HNSW once the folder is large enough to benefit.
+    Embeddings are normalized, so inner product gives cosine similarity.
+    """
+    if hnsw:
+        index = faiss.IndexHNSWFlat(EMBEDDING_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    return faiss.IndexFlatIP(EMBEDDING_DIM)
+
+class FolderVectorStore(FAISS):
+    """
+    FAISS store with a lock around its index and id map. Searches run in worker threads
+    while uploads and deletes modify the store, and FAISS indexes can't be read during a
+    write, so every search and every in-place change holds the lock.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+def check_new_ids(store: FAISS, ids: List[str]):
+    """
+    Reject ids that are repeated or already in the store. LangChain adds vectors to the
+    index before it checks the docstore, so a duplicate would leave the index with more
+    rows than index_to_docstore_id and break every later search.
+    """
+    if len(set(ids)) != len(ids):
+        raise ValueError("Duplicate chunk ids in one addition")
+    existing = [doc_id for doc_id in ids if doc_id in store.docstore._dict]
+    if existing:
+        raise ValueError(f"Chunk ids already in the vector store: {existing[:3]}")
+
+def create_vector_store(text_embeddings, metadatas, ids) -> FolderVectorStore:
+    store = FolderVectorStore(
+        embedding_function=embeddings,
+        index=new_faiss_index(use_hnsw(len(text_embeddings), currently_hnsw=False)),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    check_new_ids(store, ids)
+    store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+    return store
+
+def load_vector_store(vectorstore_path: str) -> FolderVectorStore:
+    # The docstore pickle is only ever written by this server's own save_local, never
+    # taken from uploads, so unpickling it is safe
+    return FolderVectorStore.load_local(
+        vectorstore_path,
+        embeddings,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        allow_dangerous_deserialization=True
+    )
+
+# Folders with no vector store on disk, mapped to when that was last checked, so
+# chats in folders without documents don't probe the filesystem on every message.
+# Entries are kept in check-time order and bounded, since folder ids come from clients
+MISSING_VECTOR_STORE_TTL = 60
+MAX_MISSING_VECTOR_STORES = 1024
+missing_vector_stores: Dict[str, float] = {}
+
+def remember_missing_vector_store(folder_id: str):
+    now = time.monotonic()
+    missing_vector_stores.pop(folder_id, None)
+    missing_vector_stores[folder_id] = now
+
+    # Oldest entries come first: drop expired ones, then any beyond the bound
+    for stale_id in list(missing_vector_stores):
+        if now - missing_vector_stores[stale_id] < MISSING_VECTOR_STORE_TTL and len(missing_vector_stores) <= MAX_MISSING_VECTOR_STORES:
+            break
+        del missing_vector_stores[stale_id]
+
+async def get_vector_store(folder_id: str) -> Optional[FolderVectorStore]:
+    """Return the folder's vector store, loading it from disk if it isn't in memory yet"""
+    store = vector_stores.get(folder_id)
+    if store is not None:
+        return store
+
+    checked_at = missing_vector_stores.get(folder_id)
+    if checked_at is not None:
+        if time.monotonic() - checked_at < MISSING_VECTOR_STORE_TTL:
+            return None
+        del missing_vector_stores[folder_id]
+
+    # Load under the writer lock so a delete_file or delete_folder can't remove the
+    # store between the existence check and the insert and have it put back here
+    async with vector_store_lock:
+        # Another request may have loaded or created the store while this one waited
+        store = vector_stores.get(folder_id)
+        if store is not None:
+            return store
+
+        vectorstore_path = os.path.join(BASE_DIR, folder_id, "vectorstore")
+        if os.path.exists(os.path.join(vectorstore_path, "index.faiss")):
+            store = await asyncio.to_thread(load_vector_store, vectorstore_path)
+            vector_stores[folder_id] = store
+            return store
+
+        remember_missing_vector_store(folder_id)
+        return None
+
+# The write helpers below are blocking and meant for asyncio.to_thread. Callers hold
+# vector_store_lock, so each runs as the store's only writer: new indexes are built
+# from the current one without store.lock (searches keep using it meanwhile) and only
+# swapped in under the lock.
+
+def add_to_vector_store(store: FolderVectorStore, text_embeddings, metadatas, ids):
+    check_new_ids(store, ids)
+
+    # Upgrade a flat index to HNSW when this addition takes it over the threshold
+    new_index = None
+    if not isinstance(store.index, faiss.IndexHNSWFlat) and use_hnsw(store.index.ntotal + len(text_embeddings), currently_hnsw=False):
+        new_index = new_faiss_index(hnsw=True)
+        new_index.add(store.index.reconstruct_n(0, store.index.ntotal))
+
+    with store.lock:
+        if new_index is not None:
+            store.index = new_index
+        store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+
+def delete_from_vector_store(store: FolderVectorStore, ids: List[str]):
+    if not isinstance(store.index, faiss.IndexHNSWFlat):
+        with store.lock:
+            store.delete(ids=ids)
+        return
+
+    # HNSW graphs don't support remove_ids, so rebuild the index from the vectors that remain
+    ids_to_delete = set(ids)
+    keep = [
+        position for position, doc_id in sorted(store.index_to_docstore_id.items())
+        if doc_id not in ids_to_delete
+    ]
+    new_index = new_faiss_index(use_hnsw(len(keep), currently_hnsw=True))
+    new_index.add(store.index.reconstruct_n(0, store.index.ntotal)[keep])
+    new_index_to_docstore_id = {
+        new_position: store.index_to_docstore_id[old_position]
+        for new_position, old_position in enumerate(keep)
+    }
+
+    with store.lock:
+        store.index = new_index
+        store.index_to_docstore_id = new_index_to_docstore_id
+        store.docstore.delete(list(ids_to_delete))
+
+async def process_documents(file_paths: List[str]):
+    """
+    Load and chunk documents on the process pool so parsing doesn't block the event loop.
+    Returns one list of chunks per file, in input order.
+    """
+    global process_pool
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = process_pool
+        try:
+            return await asyncio.gather(*[
+                loop.run_in_executor(pool, process_document, file_path)
+                for file_path in file_paths
+            ])
+        except BrokenProcessPool:
+            # A worker died (out of memory, or a crash in a native parser), which breaks
+            # the whole pool; replace it so this and later requests can still run
+            if process_pool is pool:
+                print("Document worker pool broke, starting a new one")
+                pool.shutdown(wait=False, cancel_futures=True)
+                process_pool = new_process_pool()
+            if attempt == 1:
+                raise
 
 @app.post("/upload/{folder_id}")
 async def upload_file(folder_id: str, file: UploadFile = File(...)):
@@ -144,28 +688,38 @@ async def upload_file(folder_id: str, file: UploadFile = File(...)):
         os.makedirs(uploads_path, exist_ok=True)
         os.makedirs(vectorstore_path, exist_ok=True)
 
-        # Check if file already exists
+        # Save uploaded file. Opening with "xb" claims the name atomically, so two
+        # uploads of the same file can't both pass an existence check and interleave writes
         file_path = os.path.join(uploads_path, file.filename)
-        if os.path.exists(file_path):
+        try:
+            async with aiofiles.open(file_path, "xb") as buffer:
+                saved_file_path = file_path
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await buffer.write(chunk)
+            saved_file_stat = os.stat(file_path)
+            print(f"File saved successfully to: {file_path}")
+        except FileExistsError:
             raise HTTPException(
                 status_code=400, 
                 detail=f"File {file.filename} already exists in this folder"
             )
-
-        # Save uploaded file
-        try:
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            saved_file_path = file_path
-            print(f"File saved successfully to: {file_path}")
         except Exception as e:
             print(f"Error saving file: {str(e)}")
+            # Remove the partial file this request created
+            if saved_file_path and os.path.exists(saved_file_path):
+                os.remove(saved_file_path)
             raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
 
         # Process the document
         try:
-            chunks = process_document(file_path)
+            [chunks] = await process_documents([file_path])
             print(f"Document processed successfully into {len(chunks)} chunks")
+        except BrokenProcessPool as e:
+            # The worker crashed on this file twice; a server-side failure, not a bad request
+            print(f"Document worker crashed: {str(e)}")
+            if saved_file_path and os.path.exists(saved_file_path):
+                os.remove(saved_file_path)
+            raise HTTPException(status_code=503, detail="Document processing worker crashed, please retry")
         except Exception as e:
             print(f"Error processing document: {str(e)}")
             # Clean up saved file if processing fails
@@ -175,17 +729,41 @@ async def upload_file(folder_id: str, file: UploadFile = File(...)):
         
         # Update vector store
         try:
-            if folder_id not in vector_stores:
-                print("Creating new vector store")
-                vector_stores[folder_id] = FAISS.from_documents(chunks, embeddings)
-            else:
-                print("Adding to existing vector store")
-                vector_stores[folder_id].add_documents(chunks)
+            text_embeddings, metadatas = await asyncio.to_thread(embed_chunks, chunks)
+            ids = chunk_ids(file.filename, chunks)
+            async with vector_store_lock:
+                # The file may have been deleted (and the name even reused by another
+                # upload) while it was being parsed and embedded
+                try:
+                    still_ours = os.path.samestat(os.stat(file_path), saved_file_stat)
+                except FileNotFoundError:
+                    still_ours = False
+                if not still_ours:
+                    saved_file_path = None
+                    raise HTTPException(
+                        status_code=409,
+                        detail=f"File {file.filename} was deleted during upload"
+                    )
+
+                # Drop chunks left behind under this name, e.g. by an earlier upload that
+                # failed partway, so the fresh ids don't collide with them
+                store = vector_stores.get(folder_id)
+                stale_ids = file_chunk_ids(store, file.filename) if store else []
+                if stale_ids:
+                    await asyncio.to_thread(delete_from_vector_store, store, stale_ids)
+
+                if folder_id not in vector_stores:
+                    print("Creating new vector store")
+                    vector_stores[folder_id] = await asyncio.to_thread(create_vector_store, text_embeddings, metadatas, ids)
+                else:
+                    print("Adding to existing vector store")
+                    await asyncio.to_thread(add_to_vector_store, vector_stores[folder_id], text_embeddings, metadatas, ids)
 
-            print("Saving vector store to disk")
-            vector_stores[folder_id].save_local(vectorstore_path)
-            print("Vector store saved successfully")
+                # Written to disk by the background save task
+                dirty_vector_stores.add(folder_id)
             
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Error with vector store: {str(e)}")
             # Clean up file if vectorization fails
@@ -210,6 +788,22 @@ async def upload_file(folder_id: str, file: UploadFile = File(...)):
             os.remove(saved_file_path)
         raise HTTPException(status_code=500, detail=str(e))
 
+class ModelStreamingResponse(StreamingResponse):
+    """
+    Streams a body generated from an LM Studio response and always releases that
+    response's pooled connection, even if the client disconnects before the body starts
+    """
+
+    def __init__(self, upstream: aiohttp.ClientResponse, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upstream = upstream
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.upstream.release()
+
 @app.post("/chat/{folder_id}")
 async def chat(folder_id: str, request: dict):
     try:
@@ -218,15 +812,10 @@ async def chat(folder_id: str, request: dict):
         context = ""
         docs = []
         
-        # Try to load vector store and get context if available
-        if folder_id not in vector_stores:
-            vectorstore_path = os.path.join(get_folder_path(folder_id), "vectorstore")
-            if os.path.exists(vectorstore_path):
-                vector_stores[folder_id] = FAISS.load_local(vectorstore_path, embeddings)
-        
         # If vector store exists, get relevant documents
-        if folder_id in vector_stores:
-            docs = vector_stores[folder_id].similarity_search(message, k=3)
+        store = await get_vector_store(folder_id)
+        if store is not None:
+            docs = await query_batcher.search(store, message, k=3)
             context = "\n\n".join([doc.page_content for doc in docs])
             context_section = f"""Context information from {folder_id} is below.
 ---------------------
@@ -238,7 +827,7 @@ async def chat(folder_id: str, request: dict):
         # Load existing chat history if available
         chat_history = []
         if session_id:
-            chat_history = load_chat_history(session_id)
+            chat_history = await load_chat_history(session_id)
             
         # Add the new user message to history
         chat_history.append({"role": "user", "content": message})
@@ -255,30 +844,65 @@ async def chat(folder_id: str, request: dict):
         # Add chat history and new message
         messages.extend(chat_history)
 
-        # Send to LM Studio
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "http://localhost:1234/v1/chat/completions",
-                json={
-                    "messages": messages,
-                    "temperature": 0.7
-                }
-            ) as response:
-                if response.status != 200:
-                    raise HTTPException(status_code=response.status, detail="Model API error")
-                
-                result = await response.json()
-                assistant_message = result["choices"][0]["message"]["content"]
-                
-                # Add assistant's response to history and save
+        # Send to LM Studio, streaming tokens back as they are generated
+        response = await app.state.http.post(
+            "http://localhost:1234/v1/chat/completions",
+            json={
+                "messages": messages,
+                "temperature": 0.7,
+                "stream": True
+            }
+        )
+        try:
+            if response.status != 200:
+                raise HTTPException(status_code=response.status, detail="Model API error")
+
+            sources = [{"content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+
+            async def stream_response():
+                """Relay the model's deltas as server-sent events, preceded by a sources event"""
+                assistant_message = ""
+                yield f"event: sources\ndata: {orjson.dumps(sources).decode()}\n\n"
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    payload = line[len(b"data:"):].strip()
+                    if payload == b"[DONE]":
+                        break
+
+                    chunk = orjson.loads(payload)
+                    if "error" in chunk:
+                        error = chunk["error"]
+                        error_message = error.get("message", str(error)) if isinstance(error, dict) else str(error)
+                        print(f"Model API error during stream: {error_message}")
+                        yield f"event: error\ndata: {orjson.dumps({'error': error_message}).decode()}\n\n"
+                        return
+
+                    choices = chunk.get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        assistant_message += delta
+                        yield f"data: {orjson.dumps({'content': delta}).decode()}\n\n"
+                yield "data: [DONE]\n\n"
+
+                # Add assistant's response to history, saved once the stream has been sent
                 chat_history.append({"role": "assistant", "content": assistant_message})
-                if session_id:
-                    save_chat_history(session_id, chat_history)
-                
-                return {
-                    "response": assistant_message,
-                    "sources": [{"content": doc.page_content, "metadata": doc.metadata} for doc in docs]
-                }
+
+            async def save_answered_history():
+                # Only persist exchanges the model actually answered
+                if chat_history[-1]["role"] == "assistant":
+                    await save_chat_history(session_id, chat_history)
+
+            return ModelStreamingResponse(
+                response,
+                stream_response(),
+                media_type="text/event-stream",
+                background=BackgroundTask(save_answered_history) if session_id else None
+            )
+        except Exception:
+            response.release()
+            raise
 
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
@@ -303,9 +927,11 @@ async def delete_folder(folder_id: str):
         print(f"Attempting to delete folder: {folder_id}")  # Debug log
         
         # Remove from vector stores if exists
-        if folder_id in vector_stores:
-            print(f"Removing vector store from memory for folder {folder_id}")
-            del vector_stores[folder_id]
+        async with vector_store_lock:
+            dirty_vector_stores.discard(folder_id)
+            if folder_id in vector_stores:
+                print(f"Removing vector store from memory for folder {folder_id}")
+                del vector_stores[folder_id]
         
         # Get folder paths
         folder_path = get_folder_path(folder_id)
@@ -359,38 +985,53 @@ async def delete_file(folder_id: str, filename: str):
         uploads_path = os.path.join(folder_path, "uploads")
         file_path = os.path.join(uploads_path, filename)
         
-        # Check if file exists
-        if not os.path.exists(file_path):
-            raise HTTPException(
-                status_code=404,
-                detail=f"File {filename} not found in folder {folder_id}"
-            )
-        
-        # Delete the file
-        os.remove(file_path)
-        
-        # Rebuild vector store without the deleted file
-        remaining_files = [f for f in os.listdir(uploads_path) if os.path.isfile(os.path.join(uploads_path, f))]
-        
-        if remaining_files:
-            # Process remaining documents and rebuild vector store
-            all_chunks = []
-            for remaining_file in remaining_files:
-                file_path = os.path.join(uploads_path, remaining_file)
-                chunks = process_document(file_path)
-                all_chunks.extend(chunks)
-            
-            # Rebuild vector store
-            vectorstore_path = os.path.join(folder_path, "vectorstore")
-            vector_stores[folder_id] = FAISS.from_documents(all_chunks, embeddings)
-            vector_stores[folder_id].save_local(vectorstore_path)
-        else:
-            # If no files remain, remove the vector store
-            if folder_id in vector_stores:
-                del vector_stores[folder_id]
-            vectorstore_path = os.path.join(folder_path, "vectorstore")
-            if os.path.exists(vectorstore_path):
-                shutil.rmtree(vectorstore_path, ignore_errors=True)
+        # Deleting the file and its chunks happens under the lock, so an upload of the
+        # same name can't add its chunks in between
+        async with vector_store_lock:
+            # Check if file exists
+            if not os.path.exists(file_path):
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"File {filename} not found in folder {folder_id}"
+                )
+
+            # Delete the file
+            os.remove(file_path)
+
+            # Remove the deleted file's chunks from the vector store
+            remaining_files = [f for f in os.listdir(uploads_path) if os.path.isfile(os.path.join(uploads_path, f))]
+
+            if remaining_files:
+                store = vector_stores.get(folder_id)
+                doc_ids = list(store.index_to_docstore_id.values()) if store else []
+
+                # Stores built before chunks were tagged with "<filename>:<n>" ids can't be
+                # filtered by file, so those still get rebuilt from the remaining documents
+                if store and all(":" in doc_id for doc_id in doc_ids):
+                    ids_to_delete = file_chunk_ids(store, filename)
+                    if ids_to_delete:
+                        await asyncio.to_thread(delete_from_vector_store, store, ids_to_delete)
+                else:
+                    results = await process_documents(
+                        [os.path.join(uploads_path, remaining_file) for remaining_file in remaining_files]
+                    )
+                    all_chunks, ids = [], []
+                    for remaining_file, chunks in zip(remaining_files, results):
+                        all_chunks.extend(chunks)
+                        ids.extend(chunk_ids(remaining_file, chunks))
+
+                    text_embeddings, metadatas = await asyncio.to_thread(embed_chunks, all_chunks)
+                    vector_stores[folder_id] = await asyncio.to_thread(create_vector_store, text_embeddings, metadatas, ids)
+
+                dirty_vector_stores.add(folder_id)
+            else:
+                # If no files remain, remove the vector store
+                dirty_vector_stores.discard(folder_id)
+                if folder_id in vector_stores:
+                    del vector_stores[folder_id]
+                vectorstore_path = os.path.join(folder_path, "vectorstore")
+                if os.path.exists(vectorstore_path):
+                    shutil.rmtree(vectorstore_path, ignore_errors=True)
         
         return {
             "message": f"File {filename} deleted successfully",
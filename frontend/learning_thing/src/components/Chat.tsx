@@ -141,6 +141,7 @@ const Chat = () => {
 
     setIsLoading(true);
     const isFirstMessage = currentChat.messages.length === 0;
+    let messagesAdded = false;
 
     try {
       const folderId = currentChat.folderId || "default";
@@ -156,11 +157,10 @@ const Chat = () => {
         }),
       });
 
-      if (!response.ok) throw new Error("Failed to get response");
+      if (!response.ok || !response.body)
+        throw new Error("Failed to get response");
 
-      const data = await response.json();
-
-      // Update the messages with the response
+      // Show the user's message with an empty reply that fills in as tokens stream
       setStore((prev) => ({
         ...prev,
         chats: prev.chats.map((chat) => {
@@ -170,33 +170,83 @@ const Chat = () => {
               messages: [
                 ...chat.messages,
                 { role: "user", content: input },
-                { role: "assistant", content: data.response },
+                { role: "assistant", content: "" },
               ],
             };
           }
           return chat;
         }),
       }));
+      messagesAdded = true;
+
+      // The response is a stream of server-sent events: a "sources" event,
+      // then one `data: {"content": ...}` event per token, then `data: [DONE]`.
+      // An "error" event means the model failed partway through the reply.
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let assistantContent = "";
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split("\n\n");
+        buffer = events.pop() ?? "";
+
+        for (const event of events) {
+          if (event.startsWith("event: sources")) continue;
+          if (event.startsWith("event: error"))
+            throw new Error("Model error while streaming the response");
+          const data = event
+            .split("\n")
+            .filter((line) => line.startsWith("data: "))
+            .map((line) => line.slice("data: ".length))
+            .join("\n");
+          if (!data || data === "[DONE]") continue;
+
+          assistantContent += JSON.parse(data).content;
+          const content = assistantContent;
+          setStore((prev) => ({
+            ...prev,
+            chats: prev.chats.map((chat) => {
+              if (chat.id === store.currentChatId) {
+                return {
+                  ...chat,
+                  messages: [
+                    ...chat.messages.slice(0, -1),
+                    { role: "assistant", content },
+                  ],
+                };
+              }
+              return chat;
+            }),
+          }));
+        }
+      }
 
       if (isFirstMessage) {
         updateChatTitle(store.currentChatId!, input);
       }
     } catch (error) {
       console.error("Error:", error);
+      const errorMessage: Message = {
+        role: "assistant",
+        content: "Sorry, there was an error processing your request.",
+      };
       setStore((prev) => ({
         ...prev,
         chats: prev.chats.map((chat) => {
           if (chat.id === store.currentChatId) {
             return {
               ...chat,
-              messages: [
-                ...chat.messages,
-                { role: "user", content: input },
-                {
-                  role: "assistant",
-                  content: "Sorry, there was an error processing your request.",
-                },
-              ],
+              // Replace the partially streamed reply if one was already shown
+              messages: messagesAdded
+                ? [...chat.messages.slice(0, -1), errorMessage]
+                : [
+                    ...chat.messages,
+                    { role: "user", content: input },
+                    errorMessage,
+                  ],
             };
           }
           return chat;